@@ -10,49 +10,92 @@
 # python3 review-reminder.py
 # optional:
 # USER_EMAILS="{\"username\":\"email\"}" : Useful if a user is unable to set their "public email" for some reason
+# USER_CACHE_PATH=".user_cache.json" : Where to persist looked-up user emails between runs
+# DEBUG=1 : Print the Teams message payload before posting it
 
+import atexit
 import os
 import json
+import time
 import requests
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import quote
+from urllib3.util.retry import Retry
 
 GITLAB_API_URL = os.getenv("GITLAB_API_URL")
 GITLAB_PRIVATE_TOKEN = os.getenv("GITLAB_PRIVATE_TOKEN")
 GITLAB_PROJECTS = os.getenv("GITLAB_PROJECTS")
 TEAMS_WEBHOOK_URL = os.getenv("TEAMS_WEBHOOK_URL")
 USER_EMAILS = os.getenv("USER_EMAILS")
+USER_CACHE_PATH = os.getenv("USER_CACHE_PATH", ".user_cache.json")
+USER_CACHE_TTL = 24 * 60 * 60
 
 headers = {"PRIVATE-TOKEN": GITLAB_PRIVATE_TOKEN}
 user_emails = json.loads(USER_EMAILS) if USER_EMAILS else {}
 
+MAX_WORKERS = 16
+
+SESSION = requests.Session()
+SESSION.headers.update(headers)
+SESSION.headers.update({"Accept": "application/json"})
+# Size the pool to the thread count and block on exhaustion so every
+# concurrent call reuses a warm keep-alive connection.
+# Back off and retry on rate limits and transient server errors, honoring
+# Retry-After, so a mid-run 429 delays the run instead of failing it
+retry = Retry(total = 5, backoff_factor = 0.5, status_forcelist = (429, 500, 502, 503, 504),
+              allowed_methods = frozenset(["GET", "POST"]), respect_retry_after_header = True)
+adapter = requests.adapters.HTTPAdapter(pool_connections = 8, pool_maxsize = MAX_WORKERS, pool_block = True,
+                                        max_retries = retry)
+SESSION.mount("https://", adapter)
+SESSION.mount("http://", adapter)
+
+@lru_cache(maxsize = None)
 def get_project_id(project):
+    # Full paths like "group/project" resolve directly; bare names fall back to a search
+    if "/" in project:
+        url = f"{GITLAB_API_URL}/projects/{quote(project, safe = '')}"
+        response = SESSION.get(url)
+        if not response.ok:
+            raise Exception(response.json())
+        return response.json()["id"]
+
     url = f"{GITLAB_API_URL}/search"
-    response = requests.get(url, params = {"scope": "projects", "search": project}, headers = headers)
+    response = SESSION.get(url, params = {"scope": "projects", "search": project})
     if not response.ok:
         raise Exception(response.json())
     projects = response.json()
     return projects[0]["id"] if projects else None
 
+def get_paginated(url, params = None):
+    # Follow the Link headers until the last page
+    results = []
+    while url:
+        response = SESSION.get(url, params = params)
+        if not response.ok:
+            raise Exception(response.json())
+        results.extend(response.json())
+        url = response.links.get("next", {}).get("url")
+        params = None  # the next url carries its own query string
+    return results
+
 def get_merge_requests(project_id):
     url = f"{GITLAB_API_URL}/projects/{project_id}/merge_requests"
-    response = requests.get(url, params = {"per_page": "100", "state": "opened"}, headers = headers)
-    if not response.ok:
-        raise Exception(response.json())
-    return response.json()
+    params = {"per_page": "100", "state": "opened", "wip": "no", "scope": "all", "with_labels_details": "false",
+              "pagination": "keyset", "order_by": "updated_at", "sort": "desc", "with_merge_status_recheck": "false"}
+    return get_paginated(url, params)
 
 def get_mr_discussions(project_id, mr_id):
     url = f"{GITLAB_API_URL}/projects/{project_id}/merge_requests/{mr_id}/discussions"
-    response = requests.get(url, headers=headers)
-    if not response.ok:
-        raise Exception(response.json())
-    return response.json()
+    return get_paginated(url, {"per_page": "100"})
 
 def get_reviewers(reviewers):
     return [reviewer["id"] for reviewer in reviewers]
 
 def request_approvers(project_id, mr_id):
     url = f"{GITLAB_API_URL}/projects/{project_id}/merge_requests/{mr_id}/approvals"
-    response = requests.get(url, headers = headers)
+    response = SESSION.get(url)
     if not response.ok:
         raise Exception(response.json())
     return get_approvers(response.json())
@@ -60,57 +103,85 @@ def request_approvers(project_id, mr_id):
 def get_approvers(approvers):
     return [approver["user"]["id"] for approver in approvers["approved_by"]]
 
-def get_user_info(user_id):
-    url = f"{GITLAB_API_URL}/users/{user_id}"
-    response = requests.get(url, headers = headers)
+email_cache = {}
+try:
+    if time.time() - os.path.getmtime(USER_CACHE_PATH) < USER_CACHE_TTL:
+        with open(USER_CACHE_PATH) as cache_file:
+            email_cache = {int(user_id): email for user_id, email in json.load(cache_file).items()}
+except (OSError, ValueError):
+    pass
+
+def save_email_cache():
+    # Drop entries without an email so a later profile update gets picked up
+    emails = {str(user_id): email for user_id, email in email_cache.items() if email}
+    if emails:
+        with open(USER_CACHE_PATH, "w") as cache_file:
+            json.dump(emails, cache_file)
+
+atexit.register(save_email_cache)
+
+def get_user_email(user):
+    if user["id"] in email_cache:
+        return email_cache[user["id"]]
+
+    # The /users list endpoint omits public_email for non-admin tokens,
+    # so fetch the single-user record
+    url = f"{GITLAB_API_URL}/users/{user['id']}"
+    response = SESSION.get(url)
     if not response.ok:
         raise Exception(response.json())
-    user_data = response.json()
-
-    username = user_data["username"]
-    name = user_data["name"]
-    email = user_data["public_email"]
-
-    if not name:
-        name = username
 
+    email = response.json()["public_email"]
     if not email:
-        email = user_emails.get(username)
-
-    return {
-        "username": username,
-        "name": name,
-        "email": email
-    }
+        email = user_emails.get(user["username"])
+
+    email_cache[user["id"]] = email
+    return email
+
+def parse_iso(timestamp):
+    # fromisoformat is much faster than strptime; normalize the trailing Z
+    if timestamp.endswith("Z"):
+        timestamp = timestamp[:-1] + "+00:00"
+    return datetime.fromisoformat(timestamp)
+
+def business_days(start, end):
+    # Count weekdays between start and end with integer math instead of walking each day
+    days = (end.date() - start.date()).days
+    if days <= 0:
+        return 0
+    full_weeks, extra = divmod(days, 7)
+    weekend = sum(1 for idx in range(extra) if (start.weekday() + 1 + idx) % 7 >= 5)
+    return days - full_weeks * 2 - weekend
 
 def make_text(text, bold = False, separator = False):
-    return [{
+    return {
         "type": "TextBlock",
         "text": text,
         "separator": separator,
         "weight": "bolder" if bold else "default"
-    }]
-
-def make_mentions(user_ids):
-    users = [get_user_info(id) for id in user_ids]
-    users = [user for user in users if user["email"]]
+    }
 
-    mentions = ' '.join(["<at>" + user["name"] + "</at>" for user in users])
+def make_mentions(users):
+    mentions = []
     entities = []
     for user in users:
+        email = get_user_email(user)
+        if not email:
+            continue
+        mentions.append("<at>" + user["name"] + "</at>")
         entities.append({
             "type": "mention",
             "text": "<at>" + user["name"] + "</at>",
             "mentioned": {
-                "id": user["email"],
+                "id": email,
                 "name": user["name"]
             }
         })
 
-    return [{
+    return {
         "type": "TextBlock",
-        "text": mentions
-    }], entities
+        "text": ' '.join(mentions)
+    }, entities
 
 def make_message(body, entities):
     return {
@@ -133,24 +204,35 @@ def make_message(body, entities):
 notified_mrs = set()
 notified_people = set()
 body = []
-entities = []
+# One mention entity per user no matter how many MRs they appear on
+entities_by_text = {}
 
 text = "Happy " + datetime.now().strftime('%A') + " Everyone!"
-body = body + make_text(text)
+body.append(make_text(text))
 text = "Here are the Merge Requests needing review..."
-body = body + make_text(text)
+body.append(make_text(text))
 
 if GITLAB_PROJECTS:
     for project in GITLAB_PROJECTS.split(','):
         project_id = get_project_id(project)
-        merge_requests = filter(lambda mr: not mr['draft'], get_merge_requests(project_id))
-
-        project_body = []
+        merge_requests = get_merge_requests(project_id)
+
+        # Fan out all the per-MR approvals and discussions requests at once.
+        # An MR with no user notes has no discussions worth fetching either.
+        mr_ids = [mr["iid"] for mr in merge_requests]
+        discussions_needed = [mr["iid"] for mr in merge_requests if mr.get("user_notes_count", 1) > 0]
+        with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+            approver_futures = {mr_id: executor.submit(request_approvers, project_id, mr_id) for mr_id in mr_ids}
+            discussion_futures = {mr_id: executor.submit(get_mr_discussions, project_id, mr_id) for mr_id in discussions_needed}
+        approvers_by_mr = {mr_id: future.result() for mr_id, future in approver_futures.items()}
+        discussions_by_mr = {mr_id: future.result() for mr_id, future in discussion_futures.items()}
+
+        # First pass: work out who is pending on each MR, without any HTTP
+        pending_by_mr = {}
         for merge_request in merge_requests:
             mr_id = merge_request["iid"]
 
-            # Fetching discussions for the MR
-            discussions = get_mr_discussions(project_id, mr_id)
+            discussions = discussions_by_mr.get(mr_id, [])
             # Find authors of unresolved discussion notes
             authors_unresolved_discussions = set()
             for discussion in discussions:
@@ -158,8 +240,11 @@ if GITLAB_PROJECTS:
                     if 'resolved' in note and not note['resolved']:
                         authors_unresolved_discussions.add(note['author']['id'])
 
+            users_by_id = {user["id"]: user for user in merge_request["reviewers"]}
+            users_by_id[merge_request["author"]["id"]] = merge_request["author"]
+
             reviewers = get_reviewers(merge_request["reviewers"])
-            approvers = request_approvers(project_id, mr_id)
+            approvers = approvers_by_mr[mr_id]
             pending = set(reviewers) - set(approvers)
 
             if len(authors_unresolved_discussions) > 0 or len(pending) == 0:
@@ -168,13 +253,25 @@ if GITLAB_PROJECTS:
                 # Notify author if any unresolved discussions, or no one to notify
                 pending.update(set([merge_request['author']['id']]))
 
+            pending_by_mr[mr_id] = [users_by_id[user_id] for user_id in pending]
+
+        # Warm the email cache for everyone pending in one concurrent batch
+        unique_users = {user["id"]: user for users in pending_by_mr.values() for user in users}
+        with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+            list(executor.map(get_user_email, unique_users.values()))
+
+        # Second pass: build the message body from the cache, with zero HTTP
+        project_body = []
+        for merge_request in merge_requests:
+            mr_id = merge_request["iid"]
+            pending = pending_by_mr[mr_id]
+
             updated_at = merge_request['updated_at']
-            updated_date = datetime.strptime(updated_at, "%Y-%m-%dT%H:%M:%S.%fZ")
-            current_date = datetime.utcnow()
+            updated_date = parse_iso(updated_at)
+            current_date = datetime.now(timezone.utc)
 
             # Don't count weekends
-            dates = (updated_date + timedelta(idx + 1) for idx in range((current_date - updated_date).days))
-            stale_days = sum(1 for day in dates if day.weekday() < 5)
+            stale_days = business_days(updated_date, current_date)
 
             stale = ""
             if stale_days > 2:
@@ -187,14 +284,18 @@ if GITLAB_PROJECTS:
 
             mention_parts, mention_entities = make_mentions(pending)
 
-            project_body = project_body + title + mention_parts
-            entities = entities + mention_entities
+            project_body.append(title)
+            project_body.append(mention_parts)
+            for entity in mention_entities:
+                entities_by_text.setdefault(entity["text"], entity)
 
             notified_mrs.add(mr_id)
-            notified_people.update(pending)
+            notified_people.update(user["id"] for user in pending)
 
         if len(project_body) > 0:
-            body = body + make_text("") + make_text(project, bold = True) + [
+            body.append(make_text(""))
+            body.append(make_text(project, bold = True))
+            body.append(
                 {
                     'type': 'ColumnSet',
                     'columns': [
@@ -216,11 +317,15 @@ if GITLAB_PROJECTS:
                         }
                     ]
                 }
-            ]
+            )
 
 if len(notified_people) > 0:
-    message = make_message(body, entities)
-    print(json.dumps(message, indent=2))
-    response = requests.post(TEAMS_WEBHOOK_URL, json = message)
+    message = make_message(body, list(entities_by_text.values()))
+    if os.getenv("DEBUG"):
+        print(json.dumps(message, indent=2))
+    # Encode once, compactly; requests' json= keyword pads every separator.
+    # Post with a bare request so the GitLab token on SESSION never leaves GitLab
+    payload = json.dumps(message, separators = (",", ":")).encode()
+    response = requests.post(TEAMS_WEBHOOK_URL, data = payload, headers = {"Content-Type": "application/json"})
 
 print(f"Notified {len(notified_people)} people about {len(notified_mrs)} MRs")